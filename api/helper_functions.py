@@ -1,11 +1,19 @@
-import json
+import hmac
 import os
+import threading
+import time
 import warnings
 import re
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import orjson
 import pandas as pd
 from bs4 import BeautifulSoup
+import lxml.html
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from fastapi import HTTPException, Security, status
 from fastapi.security import APIKeyHeader
@@ -21,12 +29,96 @@ pd.set_option('display.max_colwidth', None)
 # Set constants for environment variables
 HARDCOVER_BEARER_TOKEN = os.getenv('HARDCOVER_BEARER_TOKEN')
 BOOKBLEND_API_KEY = os.getenv("BOOKBLEND_API_KEY")
+_API_KEY_BYTES = BOOKBLEND_API_KEY.encode() if BOOKBLEND_API_KEY else b''
+
+# Goodreads scraping settings: how many pages to fetch at once, and the minimum gap between requests
+GOODREADS_MAX_WORKERS = 8
+GOODREADS_MIN_REQUEST_INTERVAL = 0.1
+
+# Shared HTTP session so Goodreads and Hardcover requests reuse keep-alive connections
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'Mozilla/5.0 (compatible; BookBlend/1.0)'})
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.5)))
+
+class _RateLimiter:
+    """Spaces out requests across threads so we stay polite to goodreads.com."""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+_goodreads_limiter = _RateLimiter(GOODREADS_MIN_REQUEST_INTERVAL)
+
+# Hardcover settings: how many Goodreads IDs go in one GraphQL query, and how many queries run at once
+HARDCOVER_BATCH_SIZE = 200
+HARDCOVER_MAX_WORKERS = 4
+
+HARDCOVER_URL = "https://hardcover-production.hasura.app/v1/graphql"
+_HARDCOVER_HEADERS = {
+    'Content-Type': 'application/json',
+    'Authorization': f'Bearer {HARDCOVER_BEARER_TOKEN}'
+}
+
+_HARDCOVER_QUERY = """
+query GetBookByGoodreadsIDs($ids: [String!]) {
+  book_mappings(
+    where: {platform: {id: {_eq: 1}}, external_id: {_in: $ids}}
+  ) {
+    external_id
+    book {
+      taggings {
+        tag {
+          tag
+        }
+      }
+    }
+  }
+}
+"""
+
+# Regex patterns for scraping the Goodreads profile page
+_BOOKS_SHELVED_RE = re.compile(r'(\d{1,3}(?:,\d{3})*|\d+)\s+books')
+_BOOKS_READ_RE = re.compile(r'read\s*\(.*?(\d{1,3}(?:,\d{3})*|\d+)\)')
+_CURRENTLY_READING_RE = re.compile(r'currently-reading&lrm;\s*\((\d{1,3}(?:,\d{3})*|\d+)\)')
+_TO_READ_RE = re.compile(r'to-read&lrm;\s*\((\d{1,3}(?:,\d{3})*|\d+)\)')
+_FRIENDS_RE = re.compile(r" Friends \((\d+)\)")
+
+# Regex patterns for the numeric columns of the Goodreads books table
+_INT_RE = re.compile(r'(\d+)')
+_RATING_RE = re.compile(r'(\d+\.\d+)')
+_PUB_YEAR_RE = re.compile(r'(?:\b\d{1,2},\s)?(\d{1,4})\b')
+_DATE_READ_RE = re.compile(r'date read\s*(.*)')
+_DATE_ADDED_RE = re.compile(r'date added\s*(.*)')
+
+# Goodreads books table: our column name, and the cell class each one comes from
+_GOODREADS_FIELDS = {
+    'title': 'title',
+    'author': 'author',
+    'pages': 'num_pages',
+    'avg_goodreads_rating': 'avg_rating',
+    'total_goodreads_ratings': 'num_ratings',
+    'pub': 'date_pub',
+    'user_rating': 'rating',
+    'read?': 'read_count',
+    'date_read': 'date_read',
+    'date_added': 'date_added'
+}
 
 # API key header setup
 api_key_header = APIKeyHeader(name="X-API-Key")
 
 def get_api_key(api_key_header: str = Security(api_key_header)) -> str:
-    if api_key_header == BOOKBLEND_API_KEY:
+    # Constant-time comparison so response timing doesn't leak how much of the key matched
+    if api_key_header and hmac.compare_digest(api_key_header.encode(), _API_KEY_BYTES):
         return api_key_header
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -41,137 +133,155 @@ def format_date(date_str):
         return f"{parts[0]} 1, {parts[1]}"  # Inserting default day
     return date_str
 
+def _extract_numbers(values, pattern, remove=None):
+    # Clean, match and convert each cell in a single pass, straight into a float array
+    numbers = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        if not isinstance(value, str):
+            continue
+        if remove is not None:
+            value = value.replace(remove, '')
+        match = pattern.search(value)
+        if match:
+            numbers[i] = float(match.group(1))
+    return numbers
+
 def format_and_convert_date(series, date_pattern):
     series = series.str.extract(date_pattern)[0]
     series = series.replace('not set', pd.NA)
-    series = series.apply(lambda x: f"{x.split()[0]} 1, {x.split()[1]}" if pd.notna(x) and len(x.split()) == 2 else x)
-    return pd.to_datetime(series, errors='coerce')
-
-def get_goodreads_user_books_by_page(user_id, page_num=1):
-    url = f'https://www.goodreads.com/review/list/{user_id}?page={page_num}'
-    
-    # Read the html table
-    goodreads = pd.read_html(url, attrs={'id': 'books'}, extract_links='body', displayed_only=False)
 
-    # Process the DataFrame
-    user_books = goodreads[0]
+    # 'Month Year' dates get a default day inserted, everything else is left as is
+    parts = series.str.split(n=1, expand=True).reindex(columns=[0, 1]).astype(object)
+    is_month_year = parts[1].notna() & ~parts[1].astype(str).str.contains(' ')
+    series = np.where(is_month_year, parts[0] + ' 1, ' + parts[1], series)
+    return pd.to_datetime(pd.Series(series, index=parts.index), errors='coerce')
 
-    user_books = user_books[['title', 'author', 'pages', 'rating', 'ratings', 'pub', 'rating.1', 'votes', 'started', 'read']]
-    user_books['goodreads_id'] = user_books['title'].apply(lambda x: x[1]).str.extract(r'(\d+)')
-    
-    for column in user_books.columns[:-1]:
-        user_books[column] = user_books[column].apply(lambda x: x[0])
-
-    user_books['title'] = user_books['title'].apply(lambda x: x.replace('title ', '', 1)).str.strip()
-    user_books['author'] = user_books['author'].apply(lambda x: x.replace('author ', '', 1)).apply(lambda x: x.replace(' *', '', 1)).str.strip()
-    user_books['pages'] = pd.to_numeric(user_books['pages'].str.extract(r'(\d+)')[0], errors='coerce')
-    user_books['rating'] = pd.to_numeric(user_books['rating'].str.extract(r'(\d+\.\d+)')[0], errors='coerce')
-    user_books['ratings'] = pd.to_numeric(user_books['ratings'].str.replace(',', '').str.extract(r'(\d+)')[0], errors='coerce')
-    
-    user_books.rename(columns={'rating': 'avg_goodreads_rating', 'ratings': 'total_goodreads_ratings'}, inplace=True)
+def fetch_goodreads_page_html(user_id, page_num=1):
+    url = f'https://www.goodreads.com/review/list/{user_id}?page={page_num}'
+    _goodreads_limiter.wait()
+    response = _SESSION.get(url)
+    response.raise_for_status()
+    return response.content
+
+def get_last_page_number(tree):
+    # The pagination div links to every page, so the largest number linked is the last page
+    page_links = tree.xpath('//div[@id="reviewPagination"]/a/text()')
+    return max((int(text) for text in page_links if text.strip().isdigit()), default=1)
+
+def get_goodreads_user_books_by_page(user_id, page_num=1, tree=None):
+    if tree is None:
+        tree = lxml.html.fromstring(fetch_goodreads_page_html(user_id, page_num))
+
+    # Read the html table straight into lists of cell text, one list per column
+    columns = {column: [] for column in _GOODREADS_FIELDS}
+    goodreads_ids = []
+    for row in tree.xpath('//table[@id="books"]//tr[td]'):
+        for column, field in _GOODREADS_FIELDS.items():
+            cell = row.find(f'td[@class="field {field}"]')
+            columns[column].append(' '.join(cell.text_content().split()) if cell is not None else '')
+        # The Goodreads ID is the number in the title's /book/show/ link
+        title_link = row.xpath('td[@class="field title"]//a/@href')
+        goodreads_id_match = _INT_RE.search(title_link[0]) if title_link else None
+        goodreads_ids.append(goodreads_id_match.group(1) if goodreads_id_match else None)
+
+    # Arrow-backed strings keep the .str calls below in compiled code instead of looping over Python objects
+    user_books = pd.DataFrame(columns, dtype='string[pyarrow]')
+    user_books['title'] = user_books['title'].str.replace('title ', '', n=1, regex=False).str.strip()
+    user_books['author'] = user_books['author'].str.replace('author ', '', n=1, regex=False).str.replace(' *', '', n=1, regex=False).str.strip()
+    user_books['goodreads_id'] = pd.Series(goodreads_ids, dtype=object)
+
+    user_books['pages'] = _extract_numbers(user_books['pages'].to_numpy(), _INT_RE)
+    user_books['avg_goodreads_rating'] = _extract_numbers(user_books['avg_goodreads_rating'].to_numpy(), _RATING_RE)
+    user_books['total_goodreads_ratings'] = _extract_numbers(user_books['total_goodreads_ratings'].to_numpy(), _INT_RE, remove=',')
 
     # I just want "pub" to be the year. But, it can get crazy with a bunch of different date formats
-    user_books['pub'] = user_books['pub'].apply(lambda x: x.replace('date pub ', '', 1))
-    user_books['pub'] = pd.to_numeric(user_books['pub'].str.extract(r'(?:\b\d{1,2},\s)?(\d{1,4})\b')[0], errors='coerce')
+    user_books['pub'] = _extract_numbers(user_books['pub'].to_numpy(), _PUB_YEAR_RE, remove='date pub ')
 
-    # 'rating.1' is the rating the user gave the book... in text form (i.e. "did not like it" is a 1)
-    user_books.rename(columns={'rating.1': 'user_rating'}, inplace=True)
-    user_books['user_rating'] = user_books['user_rating'].str.extract(r'(.+?)\'s rating\s*(.*?)$')[1].str.strip()
+    # 'user_rating' is the rating the user gave the book... in text form (i.e. "did not like it" is a 1)
+    # The cell reads "<name>'s rating <text>", so match on how it ends. 'really liked it' has to come before 'liked it'
+    user_rating_text = user_books['user_rating'].str.strip()
     rating_mapping = {
         'did not like it': 1,
         'it was ok': 2,
-        'liked it': 3,
         'really liked it': 4,
+        'liked it': 3,
         'it was amazing': 5
     }
-    user_books['user_rating'] = user_books['user_rating'].map(rating_mapping)
+    conditions = [user_rating_text.str.endswith(text, na=False) for text in rating_mapping]
+    user_books['user_rating'] = np.select(conditions, list(rating_mapping.values()), default=np.nan)
 
-    # 'started' is actually the date read. I know, it's weird
-    user_books.rename(columns={'started': 'date_read'}, inplace=True)
-    user_books['date_read'] = format_and_convert_date(user_books['date_read'], r'date read\s*(.*)')
+    user_books['date_read'] = format_and_convert_date(user_books['date_read'], _DATE_READ_RE)
 
-    # 'read' is actual the date added.
-    user_books.rename(columns={'read': 'date_added'}, inplace=True)
-    user_books['date_added'] = format_and_convert_date(user_books['date_added'], r'date added\s*(.*)')
+    user_books['date_added'] = format_and_convert_date(user_books['date_added'], _DATE_ADDED_RE)
     
-    # So, the "votes" column is weird. It actually has a "# times read  x" value, which I am using to get the x value, then convert to a boolean
-    user_books.rename(columns={'votes': 'read?'}, inplace=True)
-    user_books['read?'] = pd.to_numeric(user_books['read?'].str.extract(r'(\d+)')[0], errors='coerce')
-    user_books['read?'] = user_books['read?'] > 0
+    # 'read?' comes from the "# times read  x" value, which I am using to get the x value, then convert to a boolean
+    user_books['read?'] = _extract_numbers(user_books['read?'].to_numpy(), _INT_RE) > 0
 
     return user_books
 
 def get_all_goodreads_user_books(user_id):
 
-    page_num = 1
-    all_books_df = pd.DataFrame()
+    # Fetch the first page on its own, and read how many pages there are from the same parsed page,
+    # so we only ever request pages that have books on them
+    print(f'Fetching {user_id}\'s Page 1...')
+    first_page_tree = lxml.html.fromstring(fetch_goodreads_page_html(user_id, 1))
+    first_page = get_goodreads_user_books_by_page(user_id, 1, tree=first_page_tree)
+    if first_page.empty:
+        print('Page 1 is empty.')
+        return pd.DataFrame()
 
-    while True:
-        print(f'Fetching {user_id}\'s Page {page_num}...')
-        books_on_page = get_goodreads_user_books_by_page(user_id, page_num)
-        if books_on_page.empty:
-            print(f'Page {page_num} is empty.')
-            break
-        all_books_df = pd.concat([all_books_df, books_on_page], ignore_index=True)
-        page_num += 1
+    frames = [first_page]
+    last_page = get_last_page_number(first_page_tree)
 
-    return all_books_df
+    # The remaining pages are I/O-bound, so fetch them concurrently
+    if last_page > 1:
+        print(f'Fetching {user_id}\'s Pages 2-{last_page}...')
+        with ThreadPoolExecutor(max_workers=min(GOODREADS_MAX_WORKERS, last_page - 1)) as executor:
+            pages = executor.map(lambda page_num: get_goodreads_user_books_by_page(user_id, page_num), range(2, last_page + 1))
+            frames.extend(page for page in pages if not page.empty)
 
-def get_genres_from_hardcover(goodreads_ids):
-    url = "https://hardcover-production.hasura.app/v1/graphql"
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {HARDCOVER_BEARER_TOKEN}'
-    }
-    
-    # Convert the Series or list of IDs to the required string format
-    ids_string = ', '.join(f'"{id_}"' for id_ in goodreads_ids)
-
-    # Construct the GraphQL query
-    query = f"""
-    query GetBookByGoodreadsIDs {{
-      book_mappings(
-        where: {{platform: {{id: {{_eq: 1}}}}, external_id: {{_in: [{ids_string}]}}}}
-      ) {{
-        external_id
-        book {{
-          taggings {{
-            tag {{
-              tag
-            }}
-          }}
-        }}
-      }}
-    }}
-    """
-
-    payload = json.dumps({"query": query, "variables": {}})
-    response = requests.post(url, headers=headers, data=payload).json()
+    return pd.concat(frames, ignore_index=True)
+
+def get_genres_from_hardcover_batch(goodreads_ids):
+    # The IDs go in as a query variable, so the query text is the same for every batch
+    payload = orjson.dumps({"query": _HARDCOVER_QUERY, "variables": {"ids": goodreads_ids}})
+    response = orjson.loads(_SESSION.post(HARDCOVER_URL, headers=_HARDCOVER_HEADERS, data=payload).content)
 
     books_json = response['data']['book_mappings']
-    flattened_data = []
+    external_ids = []
+    tags = []
 
-    # Iterate through each book entry in the JSON
+    # Iterate through each book entry in the JSON, collecting one list per column
     for entry in books_json:
-        book_id = entry['external_id']
-        
-        # Flatten the taggings into a single string separated by commas
-        tags = [tag['tag']['tag'] for tag in entry['book']['taggings']]
-        
-        # Append the flattened data to the list
-        flattened_data.append({'external_id': book_id, 'tags': tags})
+        external_ids.append(entry['external_id'])
+
+        # Flatten the taggings into a list of tag names
+        tags.append([tag['tag']['tag'] for tag in entry['book']['taggings']])
 
-    genres_df = pd.DataFrame(flattened_data)
+    genres_df = pd.DataFrame({'external_id': external_ids, 'tags': tags})
 
     return genres_df
 
+def get_genres_from_hardcover(goodreads_ids):
+    # Split the IDs into batches and query Hardcover for them concurrently
+    ids = [str(id_) for id_ in goodreads_ids if pd.notna(id_)]
+    batches = [ids[i:i + HARDCOVER_BATCH_SIZE] for i in range(0, len(ids), HARDCOVER_BATCH_SIZE)]
+    if not batches:
+        return pd.DataFrame(columns=['external_id', 'tags'])
+
+    with ThreadPoolExecutor(max_workers=min(HARDCOVER_MAX_WORKERS, len(batches))) as executor:
+        genres_dfs = list(executor.map(get_genres_from_hardcover_batch, batches))
+
+    return pd.concat(genres_dfs, ignore_index=True)
+
 def combine_goodreads_and_hardcover(goodreads_df, hardcover_df):
-    return pd.merge(goodreads_df, hardcover_df, left_on='goodreads_id', right_on='external_id', how='left')
+    return goodreads_df.join(hardcover_df.set_index('external_id'), on='goodreads_id', how='left')
 
 def get_user_info(user_id):
     url = f"https://www.goodreads.com/user/show/{user_id}"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
+    response = _SESSION.get(url)
+    soup = BeautifulSoup(response.text, 'lxml')
+    text = soup.get_text()
 
     try:
         canonical_link = soup.find('link', {'rel': 'canonical'})['href']
@@ -181,25 +291,25 @@ def get_user_info(user_id):
 
     try:
         title = soup.find('title').text
-        books_shelved_match = re.search(r'(\d{1,3}(?:,\d{3})*|\d+)\s+books', title)
+        books_shelved_match = _BOOKS_SHELVED_RE.search(title)
         books_shelved = books_shelved_match.group(1).replace(',', '')
     except AttributeError:
         books_shelved = ''
       
     try:
-        books_read_match = re.search(r'read\s*\(.*?(\d{1,3}(?:,\d{3})*|\d+)\)', soup.text)
+        books_read_match = _BOOKS_READ_RE.search(text)
         books_read = books_read_match.group(1).replace(',', '')
     except AttributeError:
         books_read = ''
 
     try:
-        currently_reading_count_match = re.search(r'currently-reading&lrm;\s*\((\d{1,3}(?:,\d{3})*|\d+)\)', soup.text)
+        currently_reading_count_match = _CURRENTLY_READING_RE.search(text)
         currently_reading_count = currently_reading_count_match.group(1).replace(',', '')
     except AttributeError:
         currently_reading_count = ''
 
     try:
-        to_read_count_match = re.search(r'to-read&lrm;\s*\((\d{1,3}(?:,\d{3})*|\d+)\)', soup.text)
+        to_read_count_match = _TO_READ_RE.search(text)
         to_read_count = to_read_count_match.group(1).replace(',', '')
     except AttributeError:
         to_read_count = ''
@@ -225,7 +335,7 @@ def get_user_info(user_id):
         username = ''
 
     try:
-        friends_match = re.search(r" Friends \((\d+)\)", soup.text)
+        friends_match = _FRIENDS_RE.search(text)
         friends = friends_match.group(1)
     except AttributeError:
         friends = ''